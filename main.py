@@ -1,19 +1,45 @@
-from fastapi import FastAPI, HTTPException, status, Query
+from fastapi import FastAPI, HTTPException, status, Query, Request, Depends, Header
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.exceptions import RequestValidationError
+from fastapi.routing import APIRoute
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import Dict, List, Optional, Tuple
 from uuid import uuid4, UUID
+from contextlib import contextmanager, asynccontextmanager
+from collections import OrderedDict
 import datetime
 import sqlite3
-import random
+import threading
+import queue
+import secrets
 import os
 import re
+import json
+import hashlib
+import hmac
+import itertools
+import orjson
+import msgspec
 # --- App Configuration ---
+class ORJSONResponse(JSONResponse):
+    # orjson is several times faster than the stdlib json on list-of-dict payloads
+    def render(self, content) -> bytes:
+        return orjson.dumps(content)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    POOL.open()
+    init_db()
+    yield
+    POOL.close()
+
 app = FastAPI(
     title="Task Management API",
     description="A simple REST API built with FastAPI to manage tasks.",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
 
 # --- CORS Middleware ---
@@ -26,6 +52,7 @@ app.add_middleware(
 )
 
 # --- Data Models (Pydantic) ---
+# Shapes that are also returned to the client (response_model) stay Pydantic.
 
 class Doctor(BaseModel):
     id: str = None
@@ -38,16 +65,6 @@ class Doctor(BaseModel):
     country_code: Optional[str] = None
     status: str = "pending" # pending, active, expired
 
-class LoginRequest(BaseModel):
-    student_id: str
-    password: str
-
-class MatchRequest(BaseModel):
-    id: str = None
-    from_id: str
-    from_name: str
-    to_student_id: str # We search by Student ID
-
 class Patient(BaseModel):
     id: str = None
     doctor_id: str
@@ -67,44 +84,223 @@ class Appointment(BaseModel):
     rank: int = 0
     notes: Optional[str] = None
 
-class ColorUpdate(BaseModel):
+# --- Request Bodies (msgspec) ---
+# Input-only bodies are decoded straight from the raw JSON by msgspec,
+# which is considerably cheaper than Pydantic validation for flat schemas.
+
+def msgspec_body(model):
+    decoder = msgspec.json.Decoder(model)
+    async def decode(request: Request):
+        try:
+            return decoder.decode(await request.body())
+        except (msgspec.ValidationError, msgspec.DecodeError) as e:
+            # Same error shape as FastAPI's own body validation
+            raise RequestValidationError([{"type": "value_error", "loc": ("body",), "msg": str(e), "input": None}])
+    decode.msgspec_model = model
+    return Depends(decode)
+
+def msgspec_schema(model) -> dict:
+    # OpenAPI operations can't hold $defs, so the (flat) definitions are inlined
+    schema = msgspec.json.schema(model)
+    defs = schema.pop("$defs", {})
+    def inline(node):
+        if isinstance(node, dict):
+            if "$ref" in node:
+                return inline(defs[node["$ref"].rsplit("/", 1)[1]])
+            return {k: inline(v) for k, v in node.items()}
+        if isinstance(node, list):
+            return [inline(v) for v in node]
+        return node
+    return inline(schema)
+
+class MsgspecRoute(APIRoute):
+    # The body is read by a Depends, so FastAPI can't see it; document it here
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        for dep in self.dependant.dependencies:
+            model = getattr(dep.call, "msgspec_model", None)
+            if model is not None:
+                body = {"required": True, "content": {"application/json": {"schema": msgspec_schema(model)}}}
+                self.openapi_extra = {"requestBody": body, **(self.openapi_extra or {})}
+
+app.router.route_class = MsgspecRoute
+
+class LoginRequest(msgspec.Struct):
+    student_id: str
+    password: str
+
+class MatchRequest(msgspec.Struct):
+    from_id: str
+    from_name: str
+    to_student_id: str # We search by Student ID
+    id: Optional[str] = None
+
+class ColorUpdate(msgspec.Struct):
     color: str
 
-class BlockedDay(BaseModel):
+class BlockedDay(msgspec.Struct):
     doctor_id: str
     day: str
 
-class ReorderRequest(BaseModel):
+class ReorderRequest(msgspec.Struct):
     ids: List[str]
 
-class MoveRequest(BaseModel):
+class MoveRequest(msgspec.Struct):
     day: str
     session: str
 
-class GlobalBlock(BaseModel):
+class GlobalBlock(msgspec.Struct):
     doctor_id: str
     day_of_week: str # Sun, Mon, Tue, Wed, Thu
     session: str # Morning, Afternoon
 
-class PasswordChange(BaseModel):
+class PasswordChange(msgspec.Struct):
     old_password: str
     new_password: str
 
-class AdminSettings(BaseModel):
+class AdminSettings(msgspec.Struct):
     key: str
     value: str
 
-class AdminLogin(BaseModel):
+class AdminLogin(msgspec.Struct):
     password: str
 
-class AdminPasswordChange(BaseModel):
+class AdminPasswordChange(msgspec.Struct):
     new_password: str
 
 # --- Database Setup (SQLite) ---
 DB_FILE = "dentbook.db"
 
+# Connections live for the whole process, so a larger per-connection statement
+# cache means each distinct SQL string is parsed once per connection.
+STATEMENT_CACHE_SIZE = 256
+
+# Hottest statements, kept as shared constants so every call site hits the
+# same cache entry.
+SQL_DOCTOR_WITH_MATCHES_BY_ID = """SELECT d.*, (SELECT group_concat(CASE WHEN a = d.id THEN b ELSE a END)
+        FROM matches WHERE a = d.id OR b = d.id) AS matches_csv
+    FROM doctors d WHERE d.id = ?"""
+SQL_DOCTOR_WITH_MATCHES_BY_STUDENT_ID = """SELECT d.*, (SELECT group_concat(CASE WHEN a = d.id THEN b ELSE a END)
+        FROM matches WHERE a = d.id OR b = d.id) AS matches_csv
+    FROM doctors d WHERE d.student_id = ?"""
+SQL_DOCTORS_BY_IDS = "SELECT * FROM doctors WHERE id IN (SELECT value FROM json_each(?))"
+SQL_DOCTORS_BY_STUDENT_IDS = "SELECT * FROM doctors WHERE student_id IN (SELECT value FROM json_each(?))"
+SQL_NEXT_RANK = """INSERT INTO slot_counters (doctor_id, day, session, next_rank) VALUES (?, ?, ?, 2)
+    ON CONFLICT DO UPDATE SET next_rank = next_rank + 1 RETURNING next_rank - 1"""
+SQL_APPOINTMENTS = "SELECT * FROM appointments WHERE doctor_id IN (SELECT value FROM json_each(?)) ORDER BY rank ASC"
+
+class Pool:
+    """One read-write connection plus a fixed set of read-only ones.
+
+    WAL mode lets the readers run SELECTs in parallel while writes are
+    funnelled through the single writer connection.
+    """
+
+    def __init__(self, db_file, pool_size=10, max_overflow=0, timeout=30.0):
+        self.db_file = db_file
+        self.pool_size = pool_size
+        self.max_overflow = max_overflow
+        self.timeout = timeout
+        self.readers = queue.Queue(maxsize=pool_size)
+        self.writer = None
+        self.writer_lock = threading.Lock()
+        self.overflow = 0
+        self.stats = {"reads": 0, "writes": 0, "waits": 0, "timeouts": 0}
+        self._stats_lock = threading.Lock()
+
+    def _connect(self, read_only=False):
+        if read_only:
+            conn = sqlite3.connect(f"file:{self.db_file}?mode=ro", uri=True, check_same_thread=False,
+                                   isolation_level=None, cached_statements=STATEMENT_CACHE_SIZE)
+        else:
+            conn = sqlite3.connect(self.db_file, check_same_thread=False,
+                                   isolation_level=None, cached_statements=STATEMENT_CACHE_SIZE)  # autocommit
+            conn.execute("PRAGMA journal_mode=WAL")
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA cache_size=-64000")  # 64 MB
+        return conn
+
+    def _count(self, key):
+        with self._stats_lock:
+            self.stats[key] += 1
+
+    def open(self):
+        # Writer first: it creates the file and switches it to WAL
+        self.writer = self._connect()
+        for _ in range(self.pool_size):
+            self.readers.put(self._connect(read_only=True))
+
+    def close(self):
+        while not self.readers.empty():
+            self.readers.get_nowait().close()
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    @contextmanager
+    def get_reader(self):
+        overflow = False
+        try:
+            conn = self.readers.get_nowait()
+        except queue.Empty:
+            with self._stats_lock:
+                overflow = self.overflow < self.max_overflow
+                if overflow:
+                    self.overflow += 1
+            if overflow:
+                conn = self._connect(read_only=True)
+            else:
+                self._count("waits")
+                try:
+                    conn = self.readers.get(timeout=self.timeout)
+                except queue.Empty:
+                    self._count("timeouts")
+                    raise HTTPException(status_code=503, detail="Database busy, please retry")
+        self._count("reads")
+        try:
+            yield conn
+        finally:
+            if overflow:
+                conn.close()
+                with self._stats_lock:
+                    self.overflow -= 1
+            else:
+                self.readers.put(conn)
+
+    @contextmanager
+    def get_writer(self):
+        with self.writer_lock:
+            self._count("writes")
+            yield self.writer
+
+    def health(self):
+        with self._stats_lock:
+            return {
+                "pool_size": self.pool_size,
+                "idle_readers": self.readers.qsize(),
+                "overflow": self.overflow,
+                "max_overflow": self.max_overflow,
+                "writer_busy": self.writer_lock.locked(),
+                **self.stats,
+            }
+
+POOL = Pool(DB_FILE, pool_size=10, max_overflow=0)
+
+@contextmanager
+def transaction(conn):
+    # Groups several statements into one commit (and one fsync)
+    conn.execute("BEGIN")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
 def init_db():
-    with sqlite3.connect(DB_FILE) as conn:
+    with POOL.get_writer() as conn:
         conn.execute("""CREATE TABLE IF NOT EXISTS doctors (
             id TEXT PRIMARY KEY,
             student_id TEXT UNIQUE,
@@ -120,11 +316,20 @@ def init_db():
         except sqlite3.OperationalError:
             pass
 
-        conn.execute("""CREATE TABLE IF NOT EXISTS matches (
-            doctor_id TEXT,
-            target_id TEXT,
-            PRIMARY KEY (doctor_id, target_id)
-        )""")
+        # Migration: one canonical row per match (a < b) instead of one row per
+        # direction. A pair with only one direction left had been removed by
+        # one side, which now ends the match for both, so it is dropped.
+        match_cols = [r['name'] for r in conn.execute("PRAGMA table_info(matches)")]
+        if "doctor_id" in match_cols:
+            with transaction(conn):
+                conn.execute("ALTER TABLE matches RENAME TO matches_old")
+                conn.execute("CREATE TABLE matches (a TEXT, b TEXT, PRIMARY KEY (a, b), CHECK (a < b))")
+                conn.execute("""INSERT INTO matches (a, b)
+                    SELECT m1.doctor_id, m1.target_id FROM matches_old m1
+                    JOIN matches_old m2 ON m2.doctor_id = m1.target_id AND m2.target_id = m1.doctor_id
+                    WHERE m1.doctor_id < m1.target_id""")
+                conn.execute("DROP TABLE matches_old")
+        conn.execute("CREATE TABLE IF NOT EXISTS matches (a TEXT, b TEXT, PRIMARY KEY (a, b), CHECK (a < b))")
         conn.execute("""CREATE TABLE IF NOT EXISTS match_requests (
             id TEXT PRIMARY KEY,
             from_id TEXT,
@@ -175,6 +380,21 @@ def init_db():
             PRIMARY KEY (doctor_id, day_of_week, session)
         )""")
         
+        # Next free rank per slot, so appending an appointment is a primary-key
+        # upsert instead of a MAX(rank) aggregate over the slot
+        counters_exist = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'slot_counters'").fetchone()
+        conn.execute("""CREATE TABLE IF NOT EXISTS slot_counters (
+            doctor_id TEXT,
+            day TEXT,
+            session TEXT,
+            next_rank INTEGER DEFAULT 1,
+            PRIMARY KEY (doctor_id, day, session)
+        )""")
+        if not counters_exist:
+            # Migration: seed counters from existing appointments
+            conn.execute("""INSERT INTO slot_counters (doctor_id, day, session, next_rank)
+                SELECT doctor_id, day, session, MAX(rank) + 1 FROM appointments GROUP BY doctor_id, day, session""")
+
         conn.execute("""CREATE TABLE IF NOT EXISTS system_settings (
             key TEXT PRIMARY KEY,
             value TEXT
@@ -193,15 +413,169 @@ def init_db():
         try: conn.execute("ALTER TABLE doctors ADD COLUMN status TEXT DEFAULT 'pending'")
         except: pass
 
-init_db()
-
-def get_matches_list(doctor_id: str) -> List[str]:
-    with sqlite3.connect(DB_FILE) as conn:
-        rows = conn.execute("SELECT target_id FROM matches WHERE doctor_id = ?", (doctor_id,)).fetchall()
-        return [r[0] for r in rows]
+        # Migration: Hashed passwords
+        try:
+            conn.execute("ALTER TABLE doctors ADD COLUMN pw_hash BLOB")
+        except sqlite3.OperationalError:
+            pass
+        # Migration: Hash any remaining plaintext passwords (one-off, scrypt is slow)
+        legacy = conn.execute("SELECT id, password FROM doctors WHERE pw_hash IS NULL AND password IS NOT NULL").fetchall()
+        if legacy:
+            with transaction(conn):
+                conn.executemany("UPDATE doctors SET pw_hash = ?, password = NULL WHERE id = ?",
+                                 [(hash_password(r['password']), r['id']) for r in legacy])
+
+        # Full-text index for doctor search; the trigram tokenizer matches
+        # substrings, so "123" finds "m1234" without a LIKE '%...%' scan.
+        # Only student_id is searched, so only student_id is indexed.
+        fts = conn.execute("SELECT sql FROM sqlite_master WHERE name = 'doctors_fts'").fetchone()
+        if fts and "username" in fts[0]:
+            # Migration: Older index also covered username
+            for trigger in ("doctors_fts_ai", "doctors_fts_ad", "doctors_fts_au"):
+                conn.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+            conn.execute("DROP TABLE doctors_fts")
+        conn.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS doctors_fts USING fts5(
+            student_id,
+            content='doctors',
+            content_rowid='rowid',
+            tokenize='trigram'
+        )""")
+        conn.execute("""CREATE TRIGGER IF NOT EXISTS doctors_fts_ai AFTER INSERT ON doctors BEGIN
+            INSERT INTO doctors_fts (rowid, student_id) VALUES (new.rowid, new.student_id);
+        END""")
+        conn.execute("""CREATE TRIGGER IF NOT EXISTS doctors_fts_ad AFTER DELETE ON doctors BEGIN
+            INSERT INTO doctors_fts (doctors_fts, rowid, student_id) VALUES ('delete', old.rowid, old.student_id);
+        END""")
+        conn.execute("""CREATE TRIGGER IF NOT EXISTS doctors_fts_au AFTER UPDATE OF student_id ON doctors BEGIN
+            INSERT INTO doctors_fts (doctors_fts, rowid, student_id) VALUES ('delete', old.rowid, old.student_id);
+            INSERT INTO doctors_fts (rowid, student_id) VALUES (new.rowid, new.student_id);
+        END""")
+        # doctors has no INTEGER PRIMARY KEY, so rowids may shift on VACUUM;
+        # rebuilding on startup keeps the index in sync (cheap at this size).
+        conn.execute("INSERT INTO doctors_fts (doctors_fts) VALUES ('rebuild')")
+
+        # Indices for the hot WHERE clauses. blocked_days and global_blocks are
+        # already served by their (doctor_id, ...) primary keys, matches.a by
+        # its (a, b) primary key.
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_appts_slot ON appointments (doctor_id, day, session, rank)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_patients_doc ON patients (doctor_id)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_match_req_to ON match_requests (to_student_id)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_matches_b ON matches (b, a)")
+        conn.execute("ANALYZE")
+
+def doctor_with_matches(row) -> Doctor:
+    # row comes from SQL_DOCTOR_WITH_MATCHES_*; ids are UUIDs so ',' is a safe separator
+    csv = row['matches_csv']
+    return Doctor.model_construct(**dict(row), matches=csv.split(",") if csv else [])  # noqa: trusted DB data
+
+# Doctor rows rarely change, so lookups are memoised (None = not found).
+# Loads record the version they started under and are only stored if it is
+# still current: a lookup that raced with a write can never land in the
+# cache late. Misses are loaded in one json_each query, however many ids.
+# Matches are mutable and are always read from the DB.
+DOCTOR_CACHE_SIZE = 4096 # Per cache; cleared when full
+DOCTOR_CACHE_VERSION = 0
+DOCTOR_BY_ID: Dict[str, Optional[sqlite3.Row]] = {}
+DOCTOR_BY_STUDENT_ID: Dict[str, Optional[sqlite3.Row]] = {}
+DOCTOR_CACHE_LOCK = threading.Lock()
+_MISSING = object()
+
+def _cached_doctors(cache, keys: List[str], sql: str, column: str) -> list:
+    version = DOCTOR_CACHE_VERSION
+    found = {}
+    for key in keys:
+        row = cache.get(key, _MISSING)
+        if row is not _MISSING:
+            found[key] = row
+    missing = [key for key in keys if key not in found]
+    if missing:
+        with POOL.get_reader() as conn:
+            rows = conn.execute(sql, (json.dumps(missing),)).fetchall()
+        loaded = dict.fromkeys(missing)
+        loaded.update((r[column], r) for r in rows)
+        with DOCTOR_CACHE_LOCK:
+            if version == DOCTOR_CACHE_VERSION:
+                if len(cache) + len(loaded) > DOCTOR_CACHE_SIZE:
+                    cache.clear()
+                cache.update(loaded)
+        found.update(loaded)
+    return [found[key] for key in keys]
+
+def get_doctors_by_ids(doctor_ids: List[str]) -> list:
+    return _cached_doctors(DOCTOR_BY_ID, doctor_ids, SQL_DOCTORS_BY_IDS, "id")
+
+def get_doctor_by_id(doctor_id: str):
+    return get_doctors_by_ids([doctor_id])[0]
+
+def get_doctor_by_student_id(student_id: str):
+    return _cached_doctors(DOCTOR_BY_STUDENT_ID, [student_id], SQL_DOCTORS_BY_STUDENT_IDS, "student_id")[0]
+
+def invalidate_doctor_cache():
+    # Call after the write has committed
+    # Locked: handlers run in threads, and a lost increment could let a
+    # stale load through the version check
+    global DOCTOR_CACHE_VERSION
+    with DOCTOR_CACHE_LOCK:
+        DOCTOR_CACHE_VERSION += 1
+        DOCTOR_BY_ID.clear()
+        DOCTOR_BY_STUDENT_ID.clear()
+
+MAX_BATCH_IDS = 500
+
+def parse_ids(ids_str: str) -> List[str]:
+    # "".split(",") is [""], so drop empty entries before checking for none
+    ids = [i for i in ids_str.split(",") if i]
+    if len(ids) > MAX_BATCH_IDS:
+        raise HTTPException(status_code=400, detail=f"Too many ids (max {MAX_BATCH_IDS})")
+    return ids
+
+# scrypt parameters; pw_hash is the 16-byte salt followed by the 32-byte key
+SCRYPT_PARAMS = {"n": 2**14, "r": 8, "p": 1, "dklen": 32}
+
+def hash_password(password: str) -> bytes:
+    salt = os.urandom(16)
+    return salt + hashlib.scrypt(password.encode(), salt=salt, **SCRYPT_PARAMS)
+
+# Hashed against when there is no stored hash, so unknown student IDs take as
+# long to reject as wrong passwords
+DUMMY_PW_HASH = bytes(16 + SCRYPT_PARAMS["dklen"])
+
+def check_password(row, password: str) -> bool:
+    pw_hash = row['pw_hash'] if row and row['pw_hash'] is not None else DUMMY_PW_HASH
+    salt, key = pw_hash[:16], pw_hash[16:]
+    ok = hmac.compare_digest(key, hashlib.scrypt(password.encode(), salt=salt, **SCRYPT_PARAMS))
+    return ok and pw_hash is not DUMMY_PW_HASH
+
+def store_password(doctor_id: str, password: str):
+    pw_hash = hash_password(password) # Slow on purpose, so done outside the writer lock
+    with POOL.get_writer() as conn:
+        conn.execute("UPDATE doctors SET pw_hash = ?, password = NULL WHERE id = ?", (pw_hash, doctor_id))
+    invalidate_doctor_cache()
+
+def stream_rows(sql: str, params, to_dict=dict, batch_size=256):
+    # Encodes a JSON array batch by batch while the cursor is read, so the
+    # first bytes go out before the whole result set is materialised.
+    with POOL.get_reader() as conn:
+        cursor = conn.execute(sql, params)
+        yield b"["
+        sep = b""
+        while rows := cursor.fetchmany(batch_size):
+            yield sep + b",".join(orjson.dumps(to_dict(r)) for r in rows)
+            sep = b","
+        yield b"]"
+
+def stream_query(sql: str, params, to_dict=dict) -> StreamingResponse:
+    # Run the generator up to its first chunk before any headers are sent:
+    # that checks out the reader and executes the query here, so pool
+    # timeouts (503) and SQL errors become real error responses instead of a
+    # truncated 200. The reader goes back to the pool when the generator
+    # finishes or is closed, so a slow client keeps one reader busy meanwhile.
+    rows = stream_rows(sql, params, to_dict)
+    head = next(rows)
+    return StreamingResponse(itertools.chain((head,), rows), media_type="application/json")
 
 def get_random_color():
-    return "#{:06x}".format(random.randint(0, 0xFFFFFF))
+    return "#" + secrets.token_hex(3)
 
 # --- API Endpoints ---
 
@@ -221,23 +595,35 @@ async def read_admin():
 async def read_super_admin():
     return FileResponse("super_admin.html")
 
+@app.get("/pool-health", tags=["Root"])
+async def pool_health():
+    return POOL.health()
+
 # --- Auth & Users ---
+# Endpoints that touch the database are plain `def` so FastAPI runs them in its
+# threadpool; as `async def` a blocking sqlite3 call would stall the event loop.
 
 # Note: We use 'r4' in the database schema for the patient ID, 
 # but the frontend displays it as "R5" as requested.
 
 @app.post("/register", status_code=201)
-async def register(doctor: Doctor):
-    with sqlite3.connect(DB_FILE) as conn:
-        # Validation: Student ID (F/M + 3-5 digits)
-        if not re.match(r"^[FfMm]\d{3,5}$", doctor.student_id):
-            raise HTTPException(status_code=400, detail="Student ID must be F or M followed by 3-5 digits (e.g. M2035)")
-        
-        # Validation: Name (No numbers)
-        if any(char.isdigit() for char in doctor.username):
-            raise HTTPException(status_code=400, detail="Name cannot contain numbers")
+def register(doctor: Doctor):
+    # Validation: Student ID (F/M + 3-5 digits)
+    if not re.match(r"^[FfMm]\d{3,5}$", doctor.student_id):
+        raise HTTPException(status_code=400, detail="Student ID must be F or M followed by 3-5 digits (e.g. M2035)")
+
+    # Validation: Name (No numbers)
+    if any(char.isdigit() for char in doctor.username):
+        raise HTTPException(status_code=400, detail="Name cannot contain numbers")
+
+    doctor.student_id = doctor.student_id.lower().strip() # Case insensitive
+    # Reject duplicates before paying for the hash; re-checked under the writer lock
+    with POOL.get_reader() as conn:
+        if conn.execute("SELECT 1 FROM doctors WHERE student_id = ?", (doctor.student_id,)).fetchone():
+            raise HTTPException(status_code=400, detail="Student ID already exists")
 
-        doctor.student_id = doctor.student_id.lower().strip() # Case insensitive
+    pw_hash = hash_password(doctor.password)
+    with POOL.get_writer() as conn:
         cursor = conn.cursor()
         # Check if exists
         existing = cursor.execute("SELECT 1 FROM doctors WHERE student_id = ?", (doctor.student_id,)).fetchone()
@@ -247,315 +633,368 @@ async def register(doctor: Doctor):
         doctor.id = str(uuid4())
         doctor.color = get_random_color() # Assign random color
         doctor.status = "pending"
-        cursor.execute("INSERT INTO doctors (id, student_id, username, password, color, phone, country_code, status) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-                       (doctor.id, doctor.student_id, doctor.username, doctor.password, doctor.color, doctor.phone, doctor.country_code, doctor.status))
-        conn.commit()
+        cursor.execute("INSERT INTO doctors (id, student_id, username, pw_hash, color, phone, country_code, status) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                       (doctor.id, doctor.student_id, doctor.username, pw_hash, doctor.color, doctor.phone, doctor.country_code, doctor.status))
+        invalidate_doctor_cache() # Drop any cached "not found" for this student ID
         
         # Get pending message
         msg = conn.execute("SELECT value FROM system_settings WHERE key='msg_pending'").fetchone()[0]
         return {"message": msg}
 
-@app.post("/login")
-async def login(creds: LoginRequest):
-    with sqlite3.connect(DB_FILE) as conn:
-        conn.row_factory = sqlite3.Row
-        student_id = creds.student_id.lower().strip()
-        row = conn.execute("SELECT * FROM doctors WHERE student_id = ? AND password = ?", 
-                           (student_id, creds.password)).fetchone()
-        if not row:
-            raise HTTPException(status_code=401, detail="Invalid credentials")
-        
-        if row['status'] != 'active':
-            key = "msg_expired" if row['status'] == 'expired' else "msg_pending"
+@app.post("/login", response_model=Doctor, response_model_exclude={"password"})
+def login(creds: LoginRequest = msgspec_body(LoginRequest)):
+    student_id = creds.student_id.lower().strip()
+    with POOL.get_reader() as conn:
+        row = conn.execute(SQL_DOCTOR_WITH_MATCHES_BY_STUDENT_ID, (student_id,)).fetchone()
+    # Hash check outside the reader, so slow logins don't starve the pool
+    if not check_password(row, creds.password):
+        raise HTTPException(status_code=401, detail="Invalid credentials")
+
+    if row['status'] != 'active':
+        key = "msg_expired" if row['status'] == 'expired' else "msg_pending"
+        with POOL.get_reader() as conn:
             msg = conn.execute("SELECT value FROM system_settings WHERE key=?", (key,)).fetchone()[0]
-            # Return 403 Forbidden with the specific message
-            raise HTTPException(status_code=403, detail=msg)
-        
-        doc = dict(row)
-        doc['matches'] = get_matches_list(doc['id'])
-        return doc
-
-@app.get("/doctors/me")
-async def get_me(id: str):
-    with sqlite3.connect(DB_FILE) as conn:
-        conn.row_factory = sqlite3.Row
-        row = conn.execute("SELECT * FROM doctors WHERE id = ?", (id,)).fetchone()
-        if not row:
-            raise HTTPException(status_code=404, detail="Doctor not found")
-        doc = dict(row)
-        doc['matches'] = get_matches_list(id)
-        return doc
-
-@app.get("/doctors")
-async def search_doctors(student_id: str = ""):
-    with sqlite3.connect(DB_FILE) as conn:
-        conn.row_factory = sqlite3.Row
-        rows = conn.execute("SELECT * FROM doctors WHERE student_id LIKE ?", (f"%{student_id}%",)).fetchall()
-        return [dict(r) for r in rows]
+        # Return 403 Forbidden with the specific message
+        raise HTTPException(status_code=403, detail=msg)
+
+    return doctor_with_matches(row)
+
+@app.get("/doctors/me", response_model=Doctor, response_model_exclude={"password"})
+def get_me(id: str):
+    with POOL.get_reader() as conn:
+        row = conn.execute(SQL_DOCTOR_WITH_MATCHES_BY_ID, (id,)).fetchone()
+    if not row:
+        raise HTTPException(status_code=404, detail="Doctor not found")
+    return doctor_with_matches(row)
+
+@app.get("/doctors", response_model=List[Doctor], response_model_exclude={"__all__": {"password"}})
+def search_doctors(student_id: str = ""):
+    if not student_id:
+        # Everyone: stream instead of building the whole list
+        return stream_query("SELECT id, student_id, username, color, phone, country_code, status FROM doctors", (),
+                            to_dict=lambda r: {**r, "matches": []})
+    with POOL.get_reader() as conn:
+        if len(student_id) < 3:
+            # Trigrams need at least 3 characters; short queries fall back to LIKE
+            rows = conn.execute("SELECT * FROM doctors WHERE student_id LIKE ?", (f"%{student_id}%",)).fetchall()
+        else:
+            query = 'student_id : "' + student_id.replace('"', '""') + '"'
+            rows = conn.execute("""SELECT d.* FROM doctors_fts JOIN doctors d ON d.rowid = doctors_fts.rowid
+                                   WHERE doctors_fts MATCH ?""", (query,)).fetchall()
+        return [Doctor.model_construct(**dict(r)) for r in rows]  # noqa: trusted DB data
 
-@app.get("/doctors/batch")
-async def get_doctors_batch(ids: str = Query(...)):
-    id_list = ids.split(",")
-    if not id_list: return []
-    placeholders = ','.join('?' for _ in id_list)
-    with sqlite3.connect(DB_FILE) as conn:
-        conn.row_factory = sqlite3.Row
-        rows = conn.execute(f"SELECT * FROM doctors WHERE id IN ({placeholders})", id_list).fetchall()
-        return [dict(r) for r in rows]
+@app.get("/doctors/batch", response_model=List[Doctor], response_model_exclude={"__all__": {"password"}})
+def get_doctors_batch(ids: str = Query(...)):
+    id_list = parse_ids(ids)
+    rows = get_doctors_by_ids(list(dict.fromkeys(id_list)))
+    return [Doctor.model_construct(**dict(r)) for r in rows if r]  # noqa: trusted DB data
 
 @app.put("/doctors/{doctor_id}/color")
-async def update_color(doctor_id: str, update: ColorUpdate):
-    with sqlite3.connect(DB_FILE) as conn:
+def update_color(doctor_id: str, update: ColorUpdate = msgspec_body(ColorUpdate)):
+    with POOL.get_writer() as conn:
         conn.execute("UPDATE doctors SET color = ? WHERE id = ?", (update.color, doctor_id))
-        conn.commit()
+    invalidate_doctor_cache()
     return {"status": "updated"}
 
 @app.put("/doctors/{doctor_id}/password")
-async def change_password(doctor_id: str, data: PasswordChange):
-    with sqlite3.connect(DB_FILE) as conn:
-        row = conn.execute("SELECT password FROM doctors WHERE id = ?", (doctor_id,)).fetchone()
-        if not row or row[0] != data.old_password:
-            raise HTTPException(status_code=400, detail="Incorrect old password")
-        
-        conn.execute("UPDATE doctors SET password = ? WHERE id = ?", (data.new_password, doctor_id))
-        conn.commit()
+def change_password(doctor_id: str, data: PasswordChange = msgspec_body(PasswordChange)):
+    row = get_doctor_by_id(doctor_id)
+    if not check_password(row, data.old_password):
+        raise HTTPException(status_code=400, detail="Incorrect old password")
+
+    store_password(doctor_id, data.new_password)
     return {"status": "changed"}
 
 # --- Matching ---
 
 @app.post("/match-request")
-async def send_match_request(req: MatchRequest):
-    with sqlite3.connect(DB_FILE) as conn:
-        conn.row_factory = sqlite3.Row
-        target = conn.execute("SELECT id FROM doctors WHERE student_id = ?", (req.to_student_id,)).fetchone()
-        
-        if not target:
-            raise HTTPException(status_code=404, detail="Student ID not found")
-        if target['id'] == req.from_id:
-            raise HTTPException(status_code=400, detail="Cannot match with self")
-        
+def send_match_request(req: MatchRequest = msgspec_body(MatchRequest)):
+    target = get_doctor_by_student_id(req.to_student_id)
+    if not target:
+        raise HTTPException(status_code=404, detail="Student ID not found")
+    if target['id'] == req.from_id:
+        raise HTTPException(status_code=400, detail="Cannot match with self")
+
+    with POOL.get_writer() as conn:
         req.id = str(uuid4())
         conn.execute("INSERT INTO match_requests (id, from_id, from_name, to_student_id) VALUES (?, ?, ?, ?)",
                      (req.id, req.from_id, req.from_name, req.to_student_id))
-        conn.commit()
         return {"message": "Request sent"}
 
 @app.get("/match-requests")
-async def get_match_requests(to_student_id: str):
-    with sqlite3.connect(DB_FILE) as conn:
-        conn.row_factory = sqlite3.Row
+def get_match_requests(to_student_id: str):
+    with POOL.get_reader() as conn:
         rows = conn.execute("SELECT * FROM match_requests WHERE to_student_id = ?", (to_student_id,)).fetchall()
         return [dict(r) for r in rows]
 
 @app.post("/match-accept/{req_id}")
-async def accept_match(req_id: str):
-    with sqlite3.connect(DB_FILE) as conn:
-        conn.row_factory = sqlite3.Row
-        req = conn.execute("SELECT * FROM match_requests WHERE id = ?", (req_id,)).fetchone()
+def accept_match(req_id: str):
+    with POOL.get_writer() as conn, transaction(conn):
+        # SQLite does not allow DML inside a CTE, so consume the request with
+        # DELETE ... RETURNING and add the match in a second statement.
+        req = conn.execute("DELETE FROM match_requests WHERE id = ? RETURNING from_id, to_student_id", (req_id,)).fetchall()
         if not req:
             raise HTTPException(status_code=404)
-        
-        # Get target ID (the one who accepted)
-        target = conn.execute("SELECT id FROM doctors WHERE student_id = ?", (req['to_student_id'],)).fetchone()
-        
-        if target:
-            # Add bidirectional match
-            conn.execute("INSERT OR IGNORE INTO matches (doctor_id, target_id) VALUES (?, ?)", (target['id'], req['from_id']))
-            conn.execute("INSERT OR IGNORE INTO matches (doctor_id, target_id) VALUES (?, ?)", (req['from_id'], target['id']))
-        
-        conn.execute("DELETE FROM match_requests WHERE id = ?", (req_id,))
-        conn.commit()
+        req = req[0]
+
+        # Match with the one who accepted (if they still exist), stored once as (a < b)
+        conn.execute("""WITH target AS (SELECT id FROM doctors WHERE student_id = ?)
+            INSERT OR IGNORE INTO matches (a, b) SELECT min(id, ?), max(id, ?) FROM target""",
+            (req['to_student_id'], req['from_id'], req['from_id']))
         return {"message": "Matched"}
 
 @app.delete("/matches/{doctor_id}/{target_id}")
-async def remove_match(doctor_id: str, target_id: str):
-    with sqlite3.connect(DB_FILE) as conn:
-        conn.execute("DELETE FROM matches WHERE doctor_id = ? AND target_id = ?", (doctor_id, target_id))
-        conn.commit()
+def remove_match(doctor_id: str, target_id: str):
+    with POOL.get_writer() as conn:
+        conn.execute("DELETE FROM matches WHERE a = ? AND b = ?", sorted((doctor_id, target_id)))
     return {"status": "removed"}
 
 # --- Patients ---
 
-@app.get("/patients")
-async def get_patients(doctor_id: str):
-    with sqlite3.connect(DB_FILE) as conn:
-        conn.row_factory = sqlite3.Row
+@app.get("/patients", response_model=List[Patient])
+def get_patients(doctor_id: str):
+    with POOL.get_reader() as conn:
         rows = conn.execute("SELECT * FROM patients WHERE doctor_id = ?", (doctor_id,)).fetchall()
-        return [dict(r) for r in rows]
+        return [Patient.model_construct(**dict(r)) for r in rows]  # noqa: trusted DB data
 
 @app.post("/patients")
-async def add_patient(p: Patient):
+def add_patient(p: Patient):
     p.id = str(uuid4())
-    with sqlite3.connect(DB_FILE) as conn:
+    with POOL.get_writer() as conn:
         conn.execute("INSERT INTO patients (id, doctor_id, name, r4) VALUES (?, ?, ?, ?)",
                      (p.id, p.doctor_id, p.name, p.r4 or ""))
-        conn.commit()
     return p
 
 @app.delete("/patients/{pid}")
-async def delete_patient(pid: str):
-    with sqlite3.connect(DB_FILE) as conn:
+def delete_patient(pid: str):
+    with POOL.get_writer() as conn:
         conn.execute("DELETE FROM patients WHERE id = ?", (pid,))
-        conn.commit()
     return {"status": "deleted"}
 
 # --- Appointments ---
 
+# Hot path: no response_model, rows are streamed straight from the cursor
 @app.get("/appointments")
-async def get_appointments(doctor_ids: str = Query(...)):
-    ids = doctor_ids.split(",")
+def get_appointments(doctor_ids: str = Query(...)):
+    ids = parse_ids(doctor_ids)
     if not ids: return []
-    placeholders = ','.join('?' for _ in ids)
-    with sqlite3.connect(DB_FILE) as conn:
-        conn.row_factory = sqlite3.Row
-        rows = conn.execute(f"SELECT * FROM appointments WHERE doctor_id IN ({placeholders}) ORDER BY rank ASC", ids).fetchall()
-        return [dict(r) for r in rows]
+    return stream_query(SQL_APPOINTMENTS, (json.dumps(ids),))
 
 @app.post("/appointments")
-async def create_appointment(appt: Appointment):
+def create_appointment(appt: Appointment):
     appt.id = str(uuid4())
-    with sqlite3.connect(DB_FILE) as conn:
-        # Get max rank for this slot to append at bottom
-        row = conn.execute("SELECT MAX(rank) FROM appointments WHERE doctor_id=? AND day=? AND session=?", 
-                           (appt.doctor_id, appt.day, appt.session)).fetchone()
-        new_rank = (row[0] if row[0] is not None else 0) + 1
+    with POOL.get_writer() as conn, transaction(conn):
+        # Take the next rank for this slot to append at bottom
+        new_rank = conn.execute(SQL_NEXT_RANK, (appt.doctor_id, appt.day, appt.session)).fetchall()[0][0]
 
         conn.execute("""INSERT INTO appointments 
             (id, doctor_id, day, session, patient_name, patient_r4, duration, type, other_type_details, rank, notes) 
             VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
             (appt.id, appt.doctor_id, appt.day, appt.session, appt.patient_name, appt.patient_r4, 
              appt.duration, appt.type, appt.other_type_details, new_rank, appt.notes))
-        conn.commit()
     return appt
 
 @app.delete("/appointments/{appt_id}")
-async def delete_appointment(appt_id: str):
-    with sqlite3.connect(DB_FILE) as conn:
+def delete_appointment(appt_id: str):
+    with POOL.get_writer() as conn:
         conn.execute("DELETE FROM appointments WHERE id = ?", (appt_id,))
-        conn.commit()
     return {"status": "deleted"}
 
 @app.put("/appointments/reorder")
-async def reorder_appointments(req: ReorderRequest):
-    with sqlite3.connect(DB_FILE) as conn:
-        for index, appt_id in enumerate(req.ids):
-            conn.execute("UPDATE appointments SET rank = ? WHERE id = ?", (index, appt_id))
-        conn.commit()
+def reorder_appointments(req: ReorderRequest = msgspec_body(ReorderRequest)):
+    with POOL.get_writer() as conn, transaction(conn):
+        conn.executemany("UPDATE appointments SET rank = ? WHERE id = ?", 
+                         ((index, appt_id) for index, appt_id in enumerate(req.ids)))
     return {"status": "reordered"}
 
 @app.put("/appointments/{appt_id}/move")
-async def move_appointment(appt_id: str, req: MoveRequest):
-    with sqlite3.connect(DB_FILE) as conn:
-        conn.execute("UPDATE appointments SET day = ?, session = ? WHERE id = ?", 
-                     (req.day, req.session, appt_id))
-        conn.commit()
+def move_appointment(appt_id: str, req: MoveRequest = msgspec_body(MoveRequest)):
+    with POOL.get_writer() as conn, transaction(conn):
+        # Append to the bottom of the new slot so its counter stays ahead of
+        # every rank in it (the UI sends a reorder straight after a move)
+        row = conn.execute("""INSERT INTO slot_counters (doctor_id, day, session, next_rank)
+            SELECT doctor_id, ?, ?, 2 FROM appointments WHERE id = ?
+            ON CONFLICT DO UPDATE SET next_rank = next_rank + 1 RETURNING next_rank - 1""",
+            (req.day, req.session, appt_id)).fetchall()
+        if row:
+            conn.execute("UPDATE appointments SET day = ?, session = ?, rank = ? WHERE id = ?", 
+                         (req.day, req.session, row[0][0], appt_id))
     return {"status": "moved"}
 
 # --- Blocked Days ---
+# Blocks change rarely but every calendar refresh polls them for each visible
+# doctor, so results are cached per doctor. BLOCKS_VER[doctor_id] is bumped
+# after every committed change; a cache entry is used only while its version
+# is current. The same versions make up the ETag, so an unchanged calendar
+# gets a 304 without touching the DB or the JSON encoder.
+BLOCKS_VER: Dict[str, int] = {}
+BLOCKS_CACHE_SIZE = 4096 # Per cache; least recently used doctors are dropped first
+DAY_BLOCKS_CACHE: "OrderedDict[str, Tuple[int, list]]" = OrderedDict()
+GLOBAL_BLOCKS_CACHE: "OrderedDict[str, Tuple[int, list]]" = OrderedDict()
+BLOCKS_CACHE_LOCK = threading.Lock()
+BLOCKS_VER_LOCK = threading.Lock()
+BLOCKS_EPOCH = secrets.token_hex(4) # Versions restart with the process, so ETags must too
+
+def bump_blocks_version(doctor_id: str):
+    # Locked so two concurrent toggles can't collapse into a single bump
+    with BLOCKS_VER_LOCK:
+        BLOCKS_VER[doctor_id] = BLOCKS_VER.get(doctor_id, 0) + 1
+
+def blocks_etag(versions: Dict[str, int]) -> str:
+    key = ",".join(f"{d}:{v}" for d, v in versions.items())
+    return '"' + BLOCKS_EPOCH + hashlib.blake2b(key.encode(), digest_size=8).hexdigest() + '"'
+
+def cached_blocks(cache, versions: Dict[str, int], load) -> Dict[str, list]:
+    # versions are read before loading, so a toggle that lands mid-load only
+    # leaves behind an entry that is already out of date (a future miss).
+    result, missing = {}, []
+    with BLOCKS_CACHE_LOCK:
+        for doctor_id, ver in versions.items():
+            hit = cache.get(doctor_id)
+            if hit and hit[0] == ver:
+                cache.move_to_end(doctor_id)
+                result[doctor_id] = hit[1]
+            else:
+                missing.append(doctor_id)
+    if missing:
+        loaded = load(missing)
+        with BLOCKS_CACHE_LOCK:
+            for doctor_id in missing:
+                result[doctor_id] = loaded.get(doctor_id, [])
+                cache[doctor_id] = (versions[doctor_id], result[doctor_id])
+                cache.move_to_end(doctor_id)
+            while len(cache) > BLOCKS_CACHE_SIZE:
+                cache.popitem(last=False)
+    return result
+
+def drop_blocks_cache(doctor_id: str):
+    with BLOCKS_CACHE_LOCK:
+        DAY_BLOCKS_CACHE.pop(doctor_id, None)
+        GLOBAL_BLOCKS_CACHE.pop(doctor_id, None)
+
+def load_day_blocks(doctor_ids: List[str]) -> Dict[str, list]:
+    with POOL.get_reader() as conn:
+        rows = conn.execute("SELECT doctor_id, day FROM blocked_days WHERE doctor_id IN (SELECT value FROM json_each(?))", 
+                            (json.dumps(doctor_ids),)).fetchall()
+    blocks = {}
+    for r in rows:
+        blocks.setdefault(r['doctor_id'], []).append(r['day'])
+    return blocks
+
+def load_global_blocks(doctor_ids: List[str]) -> Dict[str, list]:
+    with POOL.get_reader() as conn:
+        rows = conn.execute("SELECT doctor_id, day_of_week, session FROM global_blocks WHERE doctor_id IN (SELECT value FROM json_each(?))", 
+                            (json.dumps(doctor_ids),)).fetchall()
+    blocks = {}
+    for r in rows:
+        blocks.setdefault(r['doctor_id'], []).append(dict(r))
+    return blocks
+
+def blocks_headers(versions: Dict[str, int]) -> Dict[str, str]:
+    return {"ETag": blocks_etag(versions), "Cache-Control": "no-cache"} # Browsers always revalidate
 
 @app.get("/blocked-days")
-async def get_blocked_days(doctor_id: str):
-    with sqlite3.connect(DB_FILE) as conn:
-        rows = conn.execute("SELECT day FROM blocked_days WHERE doctor_id = ?", (doctor_id,)).fetchall()
-        return [r[0] for r in rows]
+def get_blocked_days(doctor_id: str, if_none_match: Optional[str] = Header(None)):
+    versions = {doctor_id: BLOCKS_VER.get(doctor_id, 0)}
+    headers = blocks_headers(versions)
+    if if_none_match and headers["ETag"] in if_none_match:
+        return Response(status_code=304, headers=headers)
+    days = cached_blocks(DAY_BLOCKS_CACHE, versions, load_day_blocks)[doctor_id]
+    return ORJSONResponse(days, headers=headers)
 
 @app.post("/blocked-days")
-async def toggle_blocked_day(data: BlockedDay):
-    with sqlite3.connect(DB_FILE) as conn:
-        existing = conn.execute("SELECT 1 FROM blocked_days WHERE doctor_id = ? AND day = ?", 
-                                (data.doctor_id, data.day)).fetchone()
-        if existing:
-            conn.execute("DELETE FROM blocked_days WHERE doctor_id = ? AND day = ?", (data.doctor_id, data.day))
-            conn.commit()
-            return {"status": "unblocked"}
-        else:
+def toggle_blocked_day(data: BlockedDay = msgspec_body(BlockedDay)):
+    with POOL.get_writer() as conn, transaction(conn):
+        # Try to unblock first; only insert if there was nothing to delete
+        removed = conn.execute("DELETE FROM blocked_days WHERE doctor_id = ? AND day = ? RETURNING 1", 
+                               (data.doctor_id, data.day)).fetchall()
+        if not removed:
             conn.execute("INSERT INTO blocked_days (doctor_id, day) VALUES (?, ?)", (data.doctor_id, data.day))
-            conn.commit()
-            return {"status": "blocked"}
+    bump_blocks_version(data.doctor_id)
+    return {"status": "unblocked" if removed else "blocked"}
 
 @app.get("/global-blocks")
-async def get_global_blocks(doctor_ids: str = Query(...)):
-    ids = doctor_ids.split(",")
+def get_global_blocks(doctor_ids: str = Query(...), if_none_match: Optional[str] = Header(None)):
+    ids = parse_ids(doctor_ids)
     if not ids: return []
-    placeholders = ','.join('?' for _ in ids)
-    with sqlite3.connect(DB_FILE) as conn:
-        conn.row_factory = sqlite3.Row
-        rows = conn.execute(f"SELECT doctor_id, day_of_week, session FROM global_blocks WHERE doctor_id IN ({placeholders})", ids).fetchall()
-        return [dict(r) for r in rows]
+    versions = {d: BLOCKS_VER.get(d, 0) for d in ids}
+    headers = blocks_headers(versions)
+    if if_none_match and headers["ETag"] in if_none_match:
+        return Response(status_code=304, headers=headers)
+    blocks = cached_blocks(GLOBAL_BLOCKS_CACHE, versions, load_global_blocks)
+    return ORJSONResponse([b for d in versions for b in blocks[d]], headers=headers)
 
 @app.post("/global-blocks")
-async def toggle_global_block(data: GlobalBlock):
-    with sqlite3.connect(DB_FILE) as conn:
-        exists = conn.execute("SELECT 1 FROM global_blocks WHERE doctor_id=? AND day_of_week=? AND session=?", 
-                              (data.doctor_id, data.day_of_week, data.session)).fetchone()
-        if exists:
-            conn.execute("DELETE FROM global_blocks WHERE doctor_id=? AND day_of_week=? AND session=?", (data.doctor_id, data.day_of_week, data.session))
-        else:
+def toggle_global_block(data: GlobalBlock = msgspec_body(GlobalBlock)):
+    with POOL.get_writer() as conn, transaction(conn):
+        removed = conn.execute("DELETE FROM global_blocks WHERE doctor_id=? AND day_of_week=? AND session=? RETURNING 1", 
+                               (data.doctor_id, data.day_of_week, data.session)).fetchall()
+        if not removed:
             conn.execute("INSERT INTO global_blocks (doctor_id, day_of_week, session) VALUES (?, ?, ?)", (data.doctor_id, data.day_of_week, data.session))
-        conn.commit()
+    bump_blocks_version(data.doctor_id)
     return {"status": "toggled"}
 
 # --- Super Admin ---
 
 @app.get("/admin/users")
-async def get_all_users():
-    with sqlite3.connect(DB_FILE) as conn:
-        conn.row_factory = sqlite3.Row
-        rows = conn.execute("SELECT * FROM doctors").fetchall()
+def get_all_users():
+    with POOL.get_reader() as conn:
+        rows = conn.execute("SELECT id, student_id, username, color, phone, country_code, status FROM doctors").fetchall()
         return [dict(r) for r in rows]
 
 @app.post("/admin/approve/{user_id}")
-async def approve_user(user_id: str):
-    with sqlite3.connect(DB_FILE) as conn:
+def approve_user(user_id: str):
+    with POOL.get_writer() as conn:
         conn.execute("UPDATE doctors SET status = 'active' WHERE id = ?", (user_id,))
-        conn.commit()
+    invalidate_doctor_cache()
     return {"status": "approved"}
 
 @app.post("/admin/deactivate/{user_id}")
-async def deactivate_user(user_id: str):
-    with sqlite3.connect(DB_FILE) as conn:
+def deactivate_user(user_id: str):
+    with POOL.get_writer() as conn:
         conn.execute("UPDATE doctors SET status = 'expired' WHERE id = ?", (user_id,))
-        conn.commit()
+    invalidate_doctor_cache()
     return {"status": "deactivated"}
 
 @app.delete("/admin/delete/{user_id}")
-async def delete_user(user_id: str):
-    with sqlite3.connect(DB_FILE) as conn:
+def delete_user(user_id: str):
+    with POOL.get_writer() as conn, transaction(conn):
         conn.execute("DELETE FROM doctors WHERE id = ?", (user_id,))
         conn.execute("DELETE FROM appointments WHERE doctor_id = ?", (user_id,))
         conn.execute("DELETE FROM patients WHERE doctor_id = ?", (user_id,))
-        conn.execute("DELETE FROM matches WHERE doctor_id = ? OR target_id = ?", (user_id, user_id))
+        conn.execute("DELETE FROM matches WHERE a = ? OR b = ?", (user_id, user_id))
         conn.execute("DELETE FROM match_requests WHERE from_id = ?", (user_id,))
         conn.execute("DELETE FROM blocked_days WHERE doctor_id = ?", (user_id,))
         conn.execute("DELETE FROM global_blocks WHERE doctor_id = ?", (user_id,))
-        conn.commit()
+        conn.execute("DELETE FROM slot_counters WHERE doctor_id = ?", (user_id,))
+    invalidate_doctor_cache()
+    bump_blocks_version(user_id) # Kept, so ETags issued before the delete never match again
+    drop_blocks_cache(user_id)
     return {"status": "deleted"}
 
 @app.post("/admin/deactivate-all")
-async def deactivate_all_users():
-    with sqlite3.connect(DB_FILE) as conn:
+def deactivate_all_users():
+    with POOL.get_writer() as conn:
         conn.execute("UPDATE doctors SET status = 'expired'")
-        conn.commit()
+    invalidate_doctor_cache()
     return {"status": "all_expired"}
 
 @app.get("/admin/settings")
-async def get_settings():
-    with sqlite3.connect(DB_FILE) as conn:
-        conn.row_factory = sqlite3.Row
+def get_settings():
+    with POOL.get_reader() as conn:
         rows = conn.execute("SELECT * FROM system_settings").fetchall()
         return {r['key']: r['value'] for r in rows}
 
 @app.post("/admin/settings")
-async def update_settings(settings: List[AdminSettings]):
-    with sqlite3.connect(DB_FILE) as conn:
+def update_settings(settings: List[AdminSettings] = msgspec_body(List[AdminSettings])):
+    with POOL.get_writer() as conn, transaction(conn):
         for s in settings:
             conn.execute("INSERT OR REPLACE INTO system_settings (key, value) VALUES (?, ?)", (s.key, s.value))
-        conn.commit()
     return {"status": "saved"}
 
 @app.post("/admin/login")
-async def admin_login(creds: AdminLogin):
-    with sqlite3.connect(DB_FILE) as conn:
+def admin_login(creds: AdminLogin = msgspec_body(AdminLogin)):
+    with POOL.get_reader() as conn:
         row = conn.execute("SELECT value FROM system_settings WHERE key='admin_password'").fetchone()
         stored_pass = row[0] if row else "admin123"
         if creds.password != stored_pass:
@@ -563,10 +1002,9 @@ async def admin_login(creds: AdminLogin):
         return {"status": "ok"}
 
 @app.post("/admin/change-password")
-async def admin_change_password(data: AdminPasswordChange):
-    with sqlite3.connect(DB_FILE) as conn:
+def admin_change_password(data: AdminPasswordChange = msgspec_body(AdminPasswordChange)):
+    with POOL.get_writer() as conn:
         conn.execute("INSERT OR REPLACE INTO system_settings (key, value) VALUES ('admin_password', ?)", (data.new_password,))
-        conn.commit()
     return {"status": "updated"}
 
 # --- Development Server Runner ---